@@ -1,13 +1,23 @@
 #!/usr/bin/env python3
 
 import argparse
+import difflib
+import filecmp
+import functools
+import hashlib
+import importlib.util
+import json
 import os
-import platform
+import shlex
+import shutil
 import subprocess
 import sys
 import tempfile
-from concurrent.futures import ThreadPoolExecutor
-from typing import Dict, List, Optional
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from types import ModuleType
+from typing import AbstractSet, Any, Callable, Dict, List, NamedTuple, Optional, Set
 
 
 # -----------------------------------------------------------------------------
@@ -44,6 +54,19 @@ BASE_KIND_FILES = {
     "Type": "SyntaxTypeNodes.swift",
 }
 
+SYNTAX_NODES_TEMPLATE_GYB = os.path.join(
+    SWIFTSYNTAX_DIR, "SyntaxNodes.swift.gyb.template"
+)
+
+# Name of the manifest recording the inputs that the gyb-generated files in a
+# directory were generated from.
+GYB_CACHE_FILE_NAME = ".gyb_cache.json"
+
+# Name of the directory within the destination of gyb-generated files into
+# which updated files are written first. Living on the same file system as the
+# destination allows them to be moved into place by renaming them.
+GYB_TEMP_DIR_NAME = ".gyb_tmp_%d" % os.getpid()
+
 
 def fail_for_called_process_error(
     succinct_description: str,
@@ -51,7 +74,31 @@ def fail_for_called_process_error(
 ) -> None:
     printerr(f"FAIL: {succinct_description}")
     printerr(f"Executing: {escapeCmd(error.cmd)}")
-    printerr(error.output)
+    # Output that wasn't captured was already written to this process's output.
+    captured_output = error.stderr if error.stderr is not None else error.output
+    if captured_output is not None:
+        printerr(captured_output.decode("utf-8", "replace"))
+    raise SystemExit(1)
+
+
+def fail_for_gyb_template_error(
+    succinct_description: str,
+    error: "GybTemplateError"
+) -> None:
+    printerr(f"FAIL: {succinct_description}")
+    printerr(str(error))
+    raise SystemExit(1)
+
+
+def fail_for_mismatching_generated_files() -> None:
+    printerr(
+        "FAIL: Gyb-generated files committed to repository do " +
+        "not match generated ones. Please re-generate the " +
+        "gyb-files using the following command, open a PR to the " +
+        "SwiftSyntax project and merge it alongside the main PR." +
+        "$ swift-syntax/build-script.py generate-source-code " +
+        "--toolchain /path/to/toolchain.xctoolchain/usr"
+    )
     raise SystemExit(1)
 
 
@@ -86,33 +133,29 @@ def fatal_error(message: str) -> None:
     raise SystemExit(1)
 
 
-def escapeCmdArg(arg: str) -> str:
-    if '"' in arg or " " in arg:
-        return '"%s"' % arg.replace('"', '\\"')
-    else:
-        return arg
-
-
 def escapeCmd(cmd: List[str]) -> str:
-    return " ".join([escapeCmdArg(arg) for arg in cmd])
+    return shlex.join(cmd)
 
 
-def call(cmd: List[str], env: Dict[str, str] = dict(os.environ),
-         stdout: Optional[int] = None, stderr: Optional[int] = subprocess.STDOUT,
-         verbose: bool = False) -> int:
+# By default, the child process inherits the environment as well as stdout and
+# stderr of this process.
+def check_call(cmd: List[str], cwd: Optional[str] = None,
+               env: Optional[Dict[str, str]] = None,
+               stdout: Optional[int] = None, stderr: Optional[int] = None,
+               verbose: bool = False) -> None:
     if verbose:
         print(escapeCmd(cmd))
-    process = subprocess.Popen(cmd, env=env, stdout=stdout, stderr=stderr)
-    process.wait()
+    subprocess.check_call(cmd, cwd=cwd, env=env, stdout=stdout, stderr=stderr)
 
-    return process.returncode
 
-
-def check_call(cmd: List[str], cwd: Optional[str] = None,
-               env: Dict[str, str] = dict(os.environ), verbose: bool = False) -> None:
+# Returns the stdout of the child process. If `stderr` is `subprocess.PIPE`, it
+# is captured in the `CalledProcessError` raised if the process fails.
+def check_output(cmd: List[str], cwd: Optional[str] = None,
+                 env: Optional[Dict[str, str]] = None,
+                 stderr: Optional[int] = None, verbose: bool = False) -> bytes:
     if verbose:
         print(escapeCmd(cmd))
-    subprocess.check_call(cmd, cwd=cwd, env=env, stderr=subprocess.STDOUT)
+    return subprocess.check_output(cmd, cwd=cwd, env=env, stderr=stderr)
 
 
 def realpath(path: Optional[str]) -> Optional[str]:
@@ -125,6 +168,8 @@ def realpath(path: Optional[str]) -> Optional[str]:
 # Generating gyb Files
 
 
+# Only check for gyb once per process, even if multiple commands generate files.
+@functools.lru_cache(maxsize=None)
 def check_gyb_exec(gyb_exec: str) -> None:
     if not os.path.exists(gyb_exec):
         fatal_error(
@@ -140,9 +185,155 @@ Refer to README.md for more information.
         )
 
 
-def check_rsync() -> None:
-    if call(["rsync", "--version"], stdout=subprocess.DEVNULL) != 0:
-        fatal_error("Error: Could not find rsync.")
+# Raised if loading gyb or parsing or executing a gyb template fails. Only carries strings so
+# it can be passed back from the process pool's workers.
+class GybTemplateError(Exception):
+    def __init__(self, gyb_file: str, details: str) -> None:
+        super().__init__(gyb_file, details)
+        self.gyb_file = gyb_file
+        self.details = details
+
+    def __str__(self) -> str:
+        return f"Executing {self.gyb_file} failed:\n{self.details}"
+
+
+# Load the `gyb` Python module backing `gyb_exec` so templates can be rendered
+# without starting a new Python interpreter for every file. Returns `None` if
+# `gyb_exec` is not accompanied by a `gyb.py` module. The module is loaded at
+# most once per process.
+@functools.lru_cache(maxsize=None)
+def load_gyb_module(gyb_exec: str) -> Optional[ModuleType]:
+    gyb_dir = os.path.dirname(os.path.realpath(gyb_exec))
+    gyb_module_path = os.path.join(gyb_dir, "gyb.py")
+    if not os.path.exists(gyb_module_path):
+        return None
+
+    # Templates import support modules living next to gyb, just like they
+    # would if gyb was run as a script.
+    sys.path.insert(0, gyb_dir)
+
+    spec = importlib.util.spec_from_file_location("gyb", gyb_module_path)
+    gyb = importlib.util.module_from_spec(spec)
+    sys.modules["gyb"] = gyb
+    try:
+        spec.loader.exec_module(gyb)  # type: ignore
+    except Exception:
+        del sys.modules["gyb"]
+        raise GybTemplateError(gyb_module_path, traceback.format_exc())
+    return gyb
+
+
+def execute_gyb_template(
+    gyb: ModuleType,
+    gyb_file: str,
+    add_source_locations: bool,
+    gyb_defines: Dict[str, str],
+) -> str:
+    # Like gyb's command line driver, allow the template to import modules
+    # relative to its own location. Templates modify the syntax node
+    # definitions in `gyb_syntax_support` in place and sources directories have
+    # helper modules with the same name (`gyb_helpers`), so forget about all
+    # modules imported by the template afterwards. This way, every template
+    # starts out with freshly imported modules, just like in a new gyb process.
+    template_dir = os.path.dirname(gyb_file)
+    original_modules = set(sys.modules)
+    original_sys_path = list(sys.path)
+    sys.path.insert(0, template_dir)
+    try:
+        with open(gyb_file) as f:
+            ast = gyb.parse_template(gyb_file, f.read())
+        if add_source_locations:
+            return gyb.execute_template(ast, **gyb_defines)
+        else:
+            return gyb.execute_template(ast, line_directive="", **gyb_defines)
+    except Exception:
+        raise GybTemplateError(gyb_file, traceback.format_exc())
+    finally:
+        sys.path = original_sys_path
+        for name in set(sys.modules) - original_modules:
+            del sys.modules[name]
+
+
+def gyb_flags(add_source_locations: bool, gyb_defines: Dict[str, str]) -> List[str]:
+    # Source locations are added by default by gyb, and cleared by passing
+    # `--line-directive=` (nothing following the `=`) to the generator. Our
+    # flag is the reverse; we don't want them by default, only if requested.
+    flags = [] if add_source_locations else ["--line-directive="]
+    flags += ["-D%s=%s" % define for define in sorted(gyb_defines.items())]
+    return flags
+
+
+def file_sha1(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+# Compute a digest of the files besides the template itself that influence the
+# output of the templates in `sources_dir`: gyb, the syntax node definitions in
+# `gyb_syntax_support` and the templates' `gyb_helpers`.
+def gyb_dependencies_digest(gyb_exec: str, sources_dir: str) -> str:
+    gyb_dir = os.path.dirname(os.path.realpath(gyb_exec))
+    dependencies = [gyb_exec, os.path.join(gyb_dir, "gyb.py")]
+    for directory in [
+        os.path.join(gyb_dir, "gyb_syntax_support"),
+        os.path.join(sources_dir, "gyb_helpers"),
+    ]:
+        for root, _, files in os.walk(directory):
+            dependencies += [
+                os.path.join(root, file) for file in files if file.endswith(".py")
+            ]
+
+    digest = hashlib.sha1()
+    for dependency in sorted(dependencies):
+        if not os.path.exists(dependency):
+            continue
+        stat = os.stat(dependency)
+        digest.update(
+            f"{dependency}:{stat.st_mtime_ns}:{stat.st_size}\n".encode("utf-8")
+        )
+    return digest.hexdigest()
+
+
+def load_gyb_cache(destination_dir: str) -> Dict[str, Dict[str, Any]]:
+    try:
+        with open(os.path.join(destination_dir, GYB_CACHE_FILE_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_gyb_cache(destination_dir: str, cache: Dict[str, Dict[str, Any]]) -> None:
+    with open(os.path.join(destination_dir, GYB_CACHE_FILE_NAME), "w") as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+
+
+# Render `gyb_file` and return the generated source code.
+def render_gyb_file(
+    gyb_exec: str,
+    gyb_file: str,
+    add_source_locations: bool,
+    gyb_defines: Dict[str, str],
+    verbose: bool,
+) -> bytes:
+    gyb = load_gyb_module(gyb_exec)
+    if gyb is not None:
+        if verbose:
+            print("Rendering " + gyb_file)
+        return execute_gyb_template(
+            gyb, gyb_file, add_source_locations, gyb_defines
+        ).encode("utf-8")
+
+    gyb_command = [sys.executable, gyb_exec, gyb_file]
+    gyb_command += gyb_flags(add_source_locations, gyb_defines)
+    return check_output(gyb_command, stderr=subprocess.PIPE, verbose=verbose)
+
+
+def read_file_if_exists(path: str) -> Optional[bytes]:
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
 
 
 def generate_single_gyb_file(
@@ -152,132 +343,275 @@ def generate_single_gyb_file(
     destination: str,
     temp_files_dir: str,
     add_source_locations: bool,
-    additional_gyb_flags: List[str],
+    gyb_defines: Dict[str, str],
     verbose: bool,
 ) -> None:
-    # Source locations are added by default by gyb, and cleared by passing
-    # `--line-directive=` (nothing following the `=`) to the generator. Our
-    # flag is the reverse; we don't want them by default, only if requested.
-    line_directive_flags = [] if add_source_locations else ["--line-directive="]
+    temp_file = os.path.join(temp_files_dir, output_file_name)
+    destination_file = os.path.join(destination, output_file_name)
 
     # Generate the new file
-    gyb_command = [
-        sys.executable,
-        gyb_exec,
-        gyb_file,
-        "-o",
-        os.path.join(temp_files_dir, output_file_name),
-    ]
-    gyb_command += line_directive_flags
-    gyb_command += additional_gyb_flags
-
-    check_call(gyb_command, verbose=verbose)
-
-    # Copy the file if different from the file already present in
-    # gyb_generated
-    rsync_command = [
-        "rsync",
-        "--checksum",
-        os.path.join(temp_files_dir, output_file_name),
-        os.path.join(destination, output_file_name),
-    ]
+    generated = render_gyb_file(
+        gyb_exec, gyb_file, add_source_locations, gyb_defines, verbose
+    )
 
-    check_call(rsync_command, verbose=verbose)
+    # Only write the file if different from the file already present in
+    # gyb_generated. Leaving unchanged files untouched preserves their
+    # modification time so they don't trigger a rebuild. The file is moved into
+    # place from `temp_files_dir` so it is never observed half-written.
+    if read_file_if_exists(destination_file) != generated:
+        if verbose:
+            print("Updating " + destination_file)
+        with open(temp_file, "wb") as f:
+            f.write(generated)
+        os.replace(temp_file, destination_file)
+
+
+class GybTask(NamedTuple):
+    gyb_file: str
+    output_file_name: str
+    destination: str
+    temp_files_dir: str
+    gyb_defines: Dict[str, str]
+    dependencies_digest: str
+    # The manifest entry recorded for the output file by the previous run.
+    cache_entry: Optional[Dict[str, Any]]
+
+
+# The manifest entries that, besides the template's contents, need to match for
+# the output file of `task` to be up to date.
+def gyb_cache_inputs(task: GybTask, add_source_locations: bool) -> Dict[str, Any]:
+    return {
+        "template": task.gyb_file,
+        "gyb_flags": gyb_flags(add_source_locations, task.gyb_defines),
+        "dependencies": task.dependencies_digest,
+    }
+
+
+# The manifest entry recording the inputs that the output file of `task` is
+# generated from.
+def gyb_cache_entry(task: GybTask, add_source_locations: bool) -> Dict[str, Any]:
+    previous_entry = task.cache_entry or {}
+    template_stat = os.stat(task.gyb_file)
+
+    # Only hash the template if it was modified since the previous run.
+    if previous_entry.get("template_mtime") == template_stat.st_mtime_ns and \
+            previous_entry.get("template_size") == template_stat.st_size:
+        template_sha1 = previous_entry["template_sha1"]
+    else:
+        template_sha1 = file_sha1(task.gyb_file)
+
+    return {
+        **gyb_cache_inputs(task, add_source_locations),
+        "template_mtime": template_stat.st_mtime_ns,
+        "template_size": template_stat.st_size,
+        "template_sha1": template_sha1,
+    }
+
+
+# Return the manifest entry for the output file of `task` if neither its inputs
+# nor the output file itself changed since the previous run, otherwise `None`.
+# Only needs to stat files unless the template was touched.
+def up_to_date_gyb_cache_entry(
+    task: GybTask, add_source_locations: bool
+) -> Optional[Dict[str, Any]]:
+    previous_entry = task.cache_entry
+    if previous_entry is None:
+        return None
 
+    destination_file = os.path.join(task.destination, task.output_file_name)
+    try:
+        output_stat = os.stat(destination_file)
+    except FileNotFoundError:
+        return None
 
-# Generate the `.swift` files for all `.gyb` files in `sources_dir`. If
-# `destination_dir` is not `None`, the resulting files will be written to
-# `destination_dir`, otherwise they will be written to
-# `sources_dir/gyb_generated`.
-def generate_gyb_files_helper(
-    sources_dir: str,
-    destination_dir: Optional[str],
+    # The output file needs to be generated again if it was edited or restored
+    # since the previous run.
+    if previous_entry.get("output_mtime") != output_stat.st_mtime_ns or \
+            previous_entry.get("output_size") != output_stat.st_size:
+        return None
+
+    inputs = gyb_cache_inputs(task, add_source_locations)
+    if any(previous_entry.get(key) != value for key, value in inputs.items()):
+        return None
+
+    # Like Make, consider the output up to date if it is newer than the
+    # template. Changes to gyb and its support modules are already accounted
+    # for by the dependencies digest. Edited or restored outputs are always
+    # newer than their template, so they need to be unchanged, too. A template
+    # can also change without becoming newer than the output, so its
+    # modification time and size need to match as well. Otherwise, the
+    # template's hash decides.
+    template_stat = os.stat(task.gyb_file)
+    if output_stat.st_mtime_ns > template_stat.st_mtime_ns and \
+            previous_entry.get("template_mtime") == template_stat.st_mtime_ns and \
+            previous_entry.get("template_size") == template_stat.st_size:
+        return previous_entry
+
+    entry = gyb_cache_entry(task, add_source_locations)
+    if entry["template_sha1"] != previous_entry.get("template_sha1"):
+        return None
+    entry["output_mtime"] = output_stat.st_mtime_ns
+    entry["output_size"] = output_stat.st_size
+    return entry
+
+
+# Generate the output file of `task`. Returns the new manifest entry.
+def generate_gyb_task(
+    task: GybTask,
     gyb_exec: str,
     add_source_locations: bool,
     verbose: bool,
-) -> None:
-    temp_files_dir = tempfile.gettempdir()
-    make_dir_if_needed(temp_files_dir)
-
-    if destination_dir is None:
-        destination_dir = os.path.join(sources_dir, "gyb_generated")
-    make_dir_if_needed(destination_dir)
-
-    # Clear any *.swift files that are relics from the previous run.
-    clear_gyb_files_from_previous_run(
-        sources_dir, destination_dir, verbose)
-
-    def generate_gyb_file(gyb_file: str) -> None:
-        gyb_file_path = os.path.join(sources_dir, gyb_file)
-
-        # Slice off the '.gyb' to get the name for the output file
-        output_file_name = gyb_file[:-4]
-
-        generate_single_gyb_file(
-            gyb_exec,
-            gyb_file_path,
-            output_file_name,
-            destination_dir,
-            temp_files_dir,
-            add_source_locations,
-            additional_gyb_flags=[],
-            verbose=verbose,
-        )
+) -> Dict[str, Any]:
+    destination_file = os.path.join(task.destination, task.output_file_name)
+    entry = gyb_cache_entry(task, add_source_locations)
 
-    # Generate the new .swift files in `temp_files_dir` and only copy them
-    # to `destiantion_dir` if they are different than the
-    # files already residing there. This way we don't touch the generated .swift
-    # files if they haven't changed and don't trigger a rebuild.
-    gyb_files = [file for file in os.listdir(sources_dir) if file.endswith(".gyb")]
-    with ThreadPoolExecutor() as executor:
-        executor.map(generate_gyb_file, gyb_files)
+    generate_single_gyb_file(
+        gyb_exec,
+        task.gyb_file,
+        task.output_file_name,
+        task.destination,
+        task.temp_files_dir,
+        add_source_locations,
+        gyb_defines=task.gyb_defines,
+        verbose=verbose,
+    )
+    output_stat = os.stat(destination_file)
+    entry["output_mtime"] = output_stat.st_mtime_ns
+    entry["output_size"] = output_stat.st_size
+    return entry
 
 
-# Generate the syntax node `.swift` files from `SyntaxNodes.swift.gyb.template`.
-# `destination_dir` is not `None`, the resulting files will be written to
-# `destination_dir/syntax_nodes`, otherwise they will be written to
-# `sources_dir/gyb_generated/syntax_nodes`.
-def generate_syntax_node_template_gyb_files(
+# Collect the tasks to generate the `.swift` files for all `.gyb` files in
+# `sources_dir`. If `destination_dir` is not `None`, the resulting files will be
+# written to `destination_dir`, otherwise they will be written to
+# `sources_dir/gyb_generated`.
+def collect_gyb_tasks(
+    sources_dir: str,
     destination_dir: Optional[str],
     gyb_exec: str,
-    add_source_locations: bool,
-    verbose: bool
-) -> None:
-    temp_files_dir = tempfile.gettempdir()
-    make_dir_if_needed(temp_files_dir)
+) -> List[GybTask]:
+    if destination_dir is None:
+        destination_dir = os.path.join(sources_dir, "gyb_generated")
 
+    # Strip the '.gyb' extension to get the names for the output files
+    output_file_names = {}
+    with os.scandir(sources_dir) as entries:
+        for entry in entries:
+            output_file_name, extension = os.path.splitext(entry.name)
+            if extension == ".gyb":
+                output_file_names[output_file_name] = entry.path
+
+    cache = load_gyb_cache(destination_dir)
+    dependencies_digest = gyb_dependencies_digest(gyb_exec, sources_dir)
+
+    tasks = []
+    for output_file_name, gyb_file in output_file_names.items():
+        tasks.append(GybTask(
+            gyb_file=gyb_file,
+            output_file_name=output_file_name,
+            destination=destination_dir,
+            temp_files_dir=os.path.join(destination_dir, GYB_TEMP_DIR_NAME),
+            gyb_defines={},
+            dependencies_digest=dependencies_digest,
+            cache_entry=cache.get(output_file_name),
+        ))
+    return tasks
+
+
+# Collect the tasks to generate the syntax node `.swift` files from
+# `SyntaxNodes.swift.gyb.template`. If `destination_dir` is not `None`, the
+# resulting files will be written to `destination_dir/syntax_nodes`, otherwise
+# they will be written to `sources_dir/gyb_generated/syntax_nodes`.
+def collect_syntax_node_template_gyb_tasks(
+    destination_dir: Optional[str],
+    gyb_exec: str,
+) -> List[GybTask]:
     if destination_dir is None:
         destination_dir = os.path.join(SWIFTSYNTAX_DIR, "gyb_generated")
 
     template_destination = os.path.join(destination_dir, "syntax_nodes")
 
-    make_dir_if_needed(template_destination)
-    for previous_gyb_gen_file in os.listdir(template_destination):
-        if previous_gyb_gen_file.endswith(".swift"):
-            if previous_gyb_gen_file not in BASE_KIND_FILES.values():
-                check_call(
-                    ["rm", previous_gyb_gen_file],
-                    cwd=template_destination,
-                    verbose=verbose,
-                )
-
-    for base_kind in BASE_KIND_FILES:
-        output_file_name = BASE_KIND_FILES[base_kind]
-
-        gyb_file = os.path.join(
-            SWIFTSYNTAX_DIR, "SyntaxNodes.swift.gyb.template"
-        )
+    cache = load_gyb_cache(template_destination)
+    dependencies_digest = gyb_dependencies_digest(gyb_exec, SWIFTSYNTAX_DIR)
+
+    tasks = []
+    for base_kind, output_file_name in BASE_KIND_FILES.items():
+        tasks.append(GybTask(
+            gyb_file=SYNTAX_NODES_TEMPLATE_GYB,
+            output_file_name=output_file_name,
+            destination=template_destination,
+            temp_files_dir=os.path.join(template_destination, GYB_TEMP_DIR_NAME),
+            gyb_defines={"EMIT_KIND": base_kind},
+            dependencies_digest=dependencies_digest,
+            cache_entry=cache.get(output_file_name),
+        ))
+    return tasks
+
+
+# Collect the tasks to generate all gyb files. Destinations that are `None`
+# default to the `gyb_generated` directory of the corresponding sources
+# directory.
+def collect_all_gyb_tasks(
+    gyb_exec: str,
+    swiftsyntax_destination: Optional[str] = None,
+    swiftsyntaxbuilder_destination: Optional[str] = None,
+    swiftsyntaxparser_destination: Optional[str] = None,
+    swiftsyntaxbuildergenerator_destination: Optional[str] = None
+) -> List[GybTask]:
+    sources_and_destinations = [
+        (SWIFTSYNTAX_DIR, swiftsyntax_destination),
+        (SWIFTSYNTAXBUILDER_DIR, swiftsyntaxbuilder_destination),
+        (SWIFTSYNTAXPARSER_DIR, swiftsyntaxparser_destination),
+        (SWIFTSYNTAXBUILDERGENERATION_DIR,
+         swiftsyntaxbuildergenerator_destination),
+    ]
 
-        generate_single_gyb_file(
-            gyb_exec,
-            gyb_file,
-            output_file_name,
-            template_destination,
-            temp_files_dir,
-            add_source_locations,
-            additional_gyb_flags=["-DEMIT_KIND=%s" % base_kind],
-            verbose=verbose,
+    tasks = []
+    for sources_dir, destination_dir in sources_and_destinations:
+        tasks += collect_gyb_tasks(sources_dir, destination_dir, gyb_exec)
+    tasks += collect_syntax_node_template_gyb_tasks(
+        swiftsyntax_destination, gyb_exec
+    )
+    return tasks
+
+
+# Map the destination directories of `tasks` to the names of the files that are
+# generated into them.
+def output_file_names_by_destination(tasks: List[GybTask]) -> Dict[str, Set[str]]:
+    output_file_names: Dict[str, Set[str]] = {}
+    for task in tasks:
+        output_file_names.setdefault(task.destination, set()).add(
+            task.output_file_name
         )
+    return output_file_names
+
+
+# Call `function` with each of `tasks` on a process pool whose workers load gyb
+# once when they start and return the results in the order of `tasks`. As soon
+# as one of the calls raises, the remaining tasks are cancelled and the error
+# is re-raised.
+def run_gyb_tasks(
+    function: Callable[[GybTask], Any], tasks: List[GybTask], gyb_exec: str
+) -> List[Any]:
+    # An error in the pool's initializer breaks the pool without saying why, so
+    # make sure gyb can be loaded before starting any workers.
+    load_gyb_module(gyb_exec)
+
+    try:
+        with ProcessPoolExecutor(
+            initializer=load_gyb_module, initargs=(gyb_exec,)
+        ) as executor:
+            futures = [executor.submit(function, task) for task in tasks]
+            try:
+                for future in as_completed(futures):
+                    future.result()
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+    except BrokenProcessPool as e:
+        fatal_error(f"Error: A process rendering gyb templates failed: {e}")
+    return [future.result() for future in futures]
 
 
 def generate_gyb_files(
@@ -290,46 +624,99 @@ def generate_gyb_files(
     print("** Generating gyb Files **")
 
     check_gyb_exec(gyb_exec)
-    check_rsync()
 
-    generate_gyb_files_helper(
-        SWIFTSYNTAX_DIR,
-        swiftsyntax_destination,
+    tasks = collect_all_gyb_tasks(
         gyb_exec,
-        add_source_locations,
-        verbose
-    )
-    generate_gyb_files_helper(
-        SWIFTSYNTAXBUILDER_DIR,
-        swiftsyntaxbuilder_destination,
-        gyb_exec,
-        add_source_locations,
-        verbose
-    )
-    generate_gyb_files_helper(
-        SWIFTSYNTAXPARSER_DIR,
-        swiftsyntaxparser_destination,
-        gyb_exec,
-        add_source_locations,
-        verbose
-    )
-    generate_gyb_files_helper(
-        SWIFTSYNTAXBUILDERGENERATION_DIR,
-        swiftsyntaxbuildergenerator_destination,
-        gyb_exec,
-        add_source_locations,
-        verbose
-    )
-    generate_syntax_node_template_gyb_files(
-        swiftsyntax_destination,
-        gyb_exec,
-        add_source_locations,
-        verbose
+        swiftsyntax_destination=swiftsyntax_destination,
+        swiftsyntaxbuilder_destination=swiftsyntaxbuilder_destination,
+        swiftsyntaxparser_destination=swiftsyntaxparser_destination,
+        swiftsyntaxbuildergenerator_destination=swiftsyntaxbuildergenerator_destination  # noqa: E501
     )
 
+    for destination, output_file_names in \
+            output_file_names_by_destination(tasks).items():
+        make_dir_if_needed(destination)
+        # Clear any *.swift files that are relics from the previous run.
+        clear_gyb_files_from_previous_run(destination, output_file_names, verbose)
+
+    # Files whose inputs haven't changed since the previous run aren't
+    # generated at all. Checking this only requires stat calls, so do it
+    # upfront and don't spin up any workers if everything is up to date.
+    caches: Dict[str, Dict[str, Dict[str, Any]]] = {}
+    stale_tasks = []
+    for task in tasks:
+        entry = up_to_date_gyb_cache_entry(task, add_source_locations)
+        if entry is None:
+            stale_tasks.append(task)
+            continue
+        if verbose:
+            print("Up to date: " +
+                  os.path.join(task.destination, task.output_file_name))
+        caches.setdefault(task.destination, {})[task.output_file_name] = entry
+
+    if stale_tasks:
+        temp_files_dirs = {task.temp_files_dir for task in stale_tasks}
+        try:
+            for temp_files_dir in temp_files_dirs:
+                make_dir_if_needed(temp_files_dir)
+
+            # Generate the new .swift files and only write them to their
+            # destination if they are different than the files already
+            # residing there. This way we don't touch the generated .swift
+            # files if they haven't changed and don't trigger a rebuild.
+            # Rendering the templates is CPU bound, so schedule all of them on
+            # a single process pool.
+            generate = functools.partial(
+                generate_gyb_task,
+                gyb_exec=gyb_exec,
+                add_source_locations=add_source_locations,
+                verbose=verbose,
+            )
+            entries = run_gyb_tasks(generate, stale_tasks, gyb_exec)
+        finally:
+            for temp_files_dir in temp_files_dirs:
+                shutil.rmtree(temp_files_dir, ignore_errors=True)
+
+        for task, entry in zip(stale_tasks, entries):
+            caches.setdefault(task.destination, {})[task.output_file_name] = entry
+
+    for destination, cache in caches.items():
+        write_gyb_cache(destination, cache)
+
     print("** Done Generating gyb Files **")
 
 
+class GeneratedFileMismatchError(Exception):
+    pass
+
+
+# Check that the committed output file of `task` matches the file generated
+# from its template. Raises `GeneratedFileMismatchError` if it doesn't.
+def verify_gyb_task(task: GybTask, gyb_exec: str, verbose: bool) -> None:
+    destination_file = os.path.join(task.destination, task.output_file_name)
+    generated = render_gyb_file(
+        gyb_exec, task.gyb_file, False, task.gyb_defines, verbose
+    )
+    committed = read_file_if_exists(destination_file)
+
+    if committed is None:
+        raise GeneratedFileMismatchError(
+            f"{destination_file} generated from {task.gyb_file} is missing"
+        )
+    if committed != generated:
+        diff = difflib.unified_diff(
+            committed.decode("utf-8", "replace").splitlines(keepends=True),
+            generated.decode("utf-8", "replace").splitlines(keepends=True),
+            destination_file,
+            "generated from " + task.gyb_file,
+            n=0,
+        )
+        raise GeneratedFileMismatchError(
+            f"{destination_file} does not match the file generated from "
+            f"{task.gyb_file}\n" + "".join(diff)
+        )
+
+
 def run_code_generation(
     toolchain: str, build_dir: Optional[str], multiroot_data_file: Optional[str],
     release: bool, verbose: bool, swiftsyntaxbuilder_destination: str
@@ -350,13 +737,7 @@ def run_code_generation(
     if verbose:
         swiftpm_call.extend(["--verbose"])
 
-    env = dict(os.environ)
-    env["SWIFT_BUILD_SCRIPT_ENVIRONMENT"] = "1"
-    # Tell other projects in the unified build to use local dependencies
-    env["SWIFTCI_USE_LOCAL_DEPS"] = "1"
-    env["SWIFT_SYNTAX_PARSER_LIB_SEARCH_PATH"] = \
-        os.path.join(toolchain, "lib", "swift", "macosx")
-    check_call(swiftpm_call, env=env, verbose=verbose)
+    check_call(swiftpm_call, env=swiftpm_environment(toolchain), verbose=verbose)
 
 
 def make_dir_if_needed(path: str) -> None:
@@ -364,28 +745,40 @@ def make_dir_if_needed(path: str) -> None:
         os.makedirs(path)
 
 
-# Remove any files in the `gyb_generated` directory that no longer have a
-# corresponding `.gyb` file in the `Sources` directory.
+def remove_file(path: str, verbose: bool) -> None:
+    if verbose:
+        print("Removing " + path)
+    os.unlink(path)
+
+
+# Remove any `.swift` files in `destination_dir` that are not in
+# `output_file_names`, i.e. that no longer have a corresponding `.gyb` file.
 def clear_gyb_files_from_previous_run(
-    sources_dir: str, destination_dir: str, verbose: bool
+    destination_dir: str, output_file_names: AbstractSet[str], verbose: bool
 ) -> None:
-    for previous_gyb_gen_file in os.listdir(destination_dir):
-        if previous_gyb_gen_file.endswith(".swift"):
-            gyb_file = os.path.join(
-                sources_dir, previous_gyb_gen_file + ".gyb"
-            )
-            if not os.path.exists(gyb_file):
-                check_call(
-                    ["rm", previous_gyb_gen_file],
-                    cwd=destination_dir,
-                    verbose=verbose
-                )
+    with os.scandir(destination_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith(".swift") and \
+                    entry.name not in output_file_names:
+                remove_file(entry.path, verbose)
 
 
 # -----------------------------------------------------------------------------
 # Building SwiftSyntax
 
 
+# The environment in which SwiftPM is invoked to build, run or test SwiftSyntax.
+def swiftpm_environment(toolchain: str) -> Dict[str, str]:
+    return {
+        **os.environ,
+        "SWIFT_BUILD_SCRIPT_ENVIRONMENT": "1",
+        # Tell other projects in the unified build to use local dependencies
+        "SWIFTCI_USE_LOCAL_DEPS": "1",
+        "SWIFT_SYNTAX_PARSER_LIB_SEARCH_PATH":
+            os.path.join(toolchain, "lib", "swift", "macosx"),
+    }
+
+
 def get_swiftpm_invocation(
     toolchain: str, action: str, build_dir: Optional[str],
     multiroot_data_file: Optional[str], release: bool
@@ -394,8 +787,6 @@ def get_swiftpm_invocation(
 
     swiftpm_call = [swift_exec, action]
     swiftpm_call.extend(["--package-path", PACKAGE_DIR])
-    if platform.system() != "Darwin":
-        swiftpm_call.extend(["--enable-test-discovery"])
     if release:
         swiftpm_call.extend(["--configuration", "release"])
     if build_dir:
@@ -409,7 +800,8 @@ def get_swiftpm_invocation(
 class Builder(object):
     swiftpm_call: List[str]
     verbose: bool
-    toolchain: str
+    environment: Dict[str, str]
+    is_unified_build: bool
 
     def __init__(
         self,
@@ -432,71 +824,66 @@ class Builder(object):
         if verbose:
             self.swiftpm_call.extend(["--verbose"])
         self.verbose = verbose
-        self.toolchain = toolchain
+        self.environment = swiftpm_environment(toolchain)
+        self.is_unified_build = multiroot_data_file is not None
 
     def build(self, product_name: str) -> None:
         print("** Building " + product_name + " **")
+        self.run_build(["--product", product_name])
+
+    # Build all products of the package within a single build graph. SwiftPM
+    # only builds a single `--product` per invocation (rdar://53881101).
+    def build_package(self) -> None:
+        print("** Building SwiftSyntax **")
+        self.run_build([])
+
+    def run_build(self, additional_arguments: List[str]) -> None:
         command = list(self.swiftpm_call)
-        command.extend(["--product", product_name])
+        command.extend(additional_arguments)
 
-        env = dict(os.environ)
-        env["SWIFT_BUILD_SCRIPT_ENVIRONMENT"] = "1"
-        # Tell other projects in the unified build to use local dependencies
-        env["SWIFTCI_USE_LOCAL_DEPS"] = "1"
-        env["SWIFT_SYNTAX_PARSER_LIB_SEARCH_PATH"] = \
-            os.path.join(self.toolchain, "lib", "swift", "macosx")
-        check_call(command, env=env, verbose=self.verbose)
+        check_call(command, env=self.environment, verbose=self.verbose)
 
 
 # -----------------------------------------------------------------------------
 # Testing
 
 
+# Check that the gyb-generated files committed to the repository match their
+# templates by rendering the templates in memory and comparing the result with
+# the committed files.
 def verify_generated_files(gyb_exec: str, verbose: bool) -> None:
-    user_swiftsyntax_generated_dir = os.path.join(
-        SWIFTSYNTAX_DIR, "gyb_generated"
-    )
-    user_swiftsyntaxbuilder_generated_dir = os.path.join(
-        SWIFTSYNTAXBUILDER_DIR, "gyb_generated"
-    )
-    user_swiftsyntaxparser_generated_dir = os.path.join(
-        SWIFTSYNTAXPARSER_DIR, "gyb_generated"
-    )
-    user_swiftsyntaxbuildergeneration_generated_dir = os.path.join(
-        SWIFTSYNTAXBUILDERGENERATION_DIR, "gyb_generated"
-    )
-
-    self_swiftsyntax_generated_dir = tempfile.mkdtemp()
-    self_swiftsyntaxbuilder_generated_dir = tempfile.mkdtemp()
-    self_swiftsyntaxparser_generated_dir = tempfile.mkdtemp()
-    self_swiftsyntaxbuildergeneration_generated_dir = tempfile.mkdtemp()
+    print("** Verifying gyb-generated files **")
 
-    generate_gyb_files(
-        gyb_exec,
-        verbose=verbose,
-        add_source_locations=False,
-        swiftsyntax_destination=self_swiftsyntax_generated_dir,
-        swiftsyntaxbuilder_destination=self_swiftsyntaxbuilder_generated_dir,
-        swiftsyntaxparser_destination=self_swiftsyntaxparser_generated_dir,
-        swiftsyntaxbuildergenerator_destination=self_swiftsyntaxbuildergeneration_generated_dir  # noqa: E501
-    )
+    check_gyb_exec(gyb_exec)
 
-    check_generated_files_match(
-        self_swiftsyntax_generated_dir,
-        user_swiftsyntax_generated_dir
-    )
-    check_generated_files_match(
-        self_swiftsyntaxbuilder_generated_dir,
-        user_swiftsyntaxbuilder_generated_dir
-    )
-    check_generated_files_match(
-        self_swiftsyntaxparser_generated_dir,
-        user_swiftsyntaxparser_generated_dir
-    )
-    check_generated_files_match(
-        self_swiftsyntaxbuildergeneration_generated_dir,
-        user_swiftsyntaxbuildergeneration_generated_dir
-    )
+    tasks = collect_all_gyb_tasks(gyb_exec)
+
+    # All generated directories should be committed and files that aren't
+    # generated from any template any more should have been removed.
+    output_file_names = output_file_names_by_destination(tasks)
+    found_mismatches = False
+    for destination, names in output_file_names.items():
+        if not os.path.isdir(destination):
+            printerr(f"{destination} is missing")
+            found_mismatches = True
+            continue
+        with os.scandir(destination) as entries:
+            for entry in entries:
+                # Exclude dot files like .DS_Store
+                if entry.name.startswith(".") or entry.name in names or \
+                        entry.path in output_file_names:
+                    continue
+                printerr(f"{entry.path} is not generated from any gyb template")
+                found_mismatches = True
+    if found_mismatches:
+        fail_for_mismatching_generated_files()
+
+    verify = functools.partial(verify_gyb_task, gyb_exec=gyb_exec, verbose=verbose)
+    try:
+        run_gyb_tasks(verify, tasks, gyb_exec)
+    except GeneratedFileMismatchError as e:
+        printerr(str(e))
+        fail_for_mismatching_generated_files()
 
 
 def verify_code_generated_files(
@@ -507,43 +894,73 @@ def verify_code_generated_files(
         SWIFTSYNTAXBUILDER_DIR, "generated"
     )
 
-    self_swiftsyntaxbuilder_generated_dir = tempfile.mkdtemp()
+    with tempfile.TemporaryDirectory() as self_swiftsyntaxbuilder_generated_dir:
+        try:
+            run_code_generation(
+                toolchain=toolchain,
+                build_dir=build_dir,
+                multiroot_data_file=multiroot_data_file,
+                release=release,
+                verbose=verbose,
+                swiftsyntaxbuilder_destination=self_swiftsyntaxbuilder_generated_dir
+            )
+        except subprocess.CalledProcessError as e:
+            fail_for_called_process_error(
+                "Source generation using SwiftSyntaxBuilder failed",
+                e
+            )
 
-    try:
-        run_code_generation(
-            toolchain=toolchain,
-            build_dir=realpath(build_dir),
-            multiroot_data_file=multiroot_data_file,
-            release=release,
-            verbose=verbose,
-            swiftsyntaxbuilder_destination=self_swiftsyntaxbuilder_generated_dir
-        )
-    except subprocess.CalledProcessError as e:
-        fail_for_called_process_error(
-            "Source generation using SwiftSyntaxBuilder failed",
-            e
+        print("** Verifing code generated files **")
+
+        check_generated_files_match(
+            self_swiftsyntaxbuilder_generated_dir,
+            user_swiftsyntaxbuilder_generated_dir
         )
 
-    print("** Verifing code generated files **")
 
-    check_generated_files_match(
-        self_swiftsyntaxbuilder_generated_dir,
-        user_swiftsyntaxbuilder_generated_dir
+# Print the differences between the directories compared by `comparison` and
+# its subdirectories. Returns whether any differences were found.
+def print_directory_differences(comparison: filecmp.dircmp) -> bool:
+    def is_visible(name: str) -> bool:
+        # Exclude dot files like .DS_Store
+        return not name.startswith(".")
+
+    found_differences = False
+    for name in filter(is_visible, comparison.left_only):
+        printerr(f"Only in {comparison.left}: {name}")
+        found_differences = True
+    for name in filter(is_visible, comparison.right_only):
+        printerr(f"Only in {comparison.right}: {name}")
+        found_differences = True
+    # `dircmp` considers files with the same size and modification time to be
+    # equal without looking at their contents, so compare them ourselves.
+    _, diff_files, funny_files = filecmp.cmpfiles(
+        comparison.left, comparison.right, comparison.common_files, shallow=False
     )
+    for name in filter(
+        is_visible, diff_files + funny_files + comparison.common_funny
+    ):
+        left_file = os.path.join(comparison.left, name)
+        right_file = os.path.join(comparison.right, name)
+        printerr(f"Files {left_file} and {right_file} differ")
+        if os.path.isfile(left_file) and os.path.isfile(right_file):
+            with open(left_file) as left, open(right_file) as right:
+                printerr("".join(difflib.unified_diff(
+                    left.readlines(), right.readlines(),
+                    left_file, right_file, n=0
+                )))
+        found_differences = True
+    for name, subdir_comparison in comparison.subdirs.items():
+        if is_visible(name):
+            found_differences |= print_directory_differences(subdir_comparison)
+    return found_differences
 
 
 def check_generated_files_match(self_generated_dir: str,
                                 user_generated_dir: str) -> None:
-    command = [
-        "diff",
-        "--recursive",
-        "--exclude",
-        ".*",  # Exclude dot files like .DS_Store
-        "--context=0",
-        self_generated_dir,
-        user_generated_dir,
-    ]
-    check_call(command)
+    comparison = filecmp.dircmp(self_generated_dir, user_generated_dir)
+    if print_directory_differences(comparison):
+        fail_for_mismatching_generated_files()
 
 
 def verify_c_syntax_nodes_match() -> None:
@@ -616,6 +1033,8 @@ Refer to README.md for more information.
         )
 
 
+# The bin path only depends on the arguments, so only ask SwiftPM for it once.
+@functools.lru_cache(maxsize=None)
 def find_lit_test_helper_exec(
     toolchain: str, build_dir: Optional[str], release: bool
 ) -> str:
@@ -629,7 +1048,7 @@ def find_lit_test_helper_exec(
     swiftpm_call.extend(["--product", "lit-test-helper"])
     swiftpm_call.extend(["--show-bin-path"])
 
-    bin_dir = subprocess.check_output(swiftpm_call)
+    bin_dir = check_output(swiftpm_call)
     return os.path.join(bin_dir.strip().decode('utf-8'), "lit-test-helper")
 
 
@@ -684,13 +1103,7 @@ def run_xctests(toolchain: str, build_dir: Optional[str],
 
     swiftpm_call.extend(["--test-product", "SwiftSyntaxPackageTests"])
 
-    env = dict(os.environ)
-    env["SWIFT_BUILD_SCRIPT_ENVIRONMENT"] = "1"
-    # Tell other projects in the unified build to use local dependencies
-    env["SWIFTCI_USE_LOCAL_DEPS"] = "1"
-    env["SWIFT_SYNTAX_PARSER_LIB_SEARCH_PATH"] = \
-        os.path.join(toolchain, "lib", "swift", "macosx")
-    check_call(swiftpm_call, env=env, verbose=verbose)
+    check_call(swiftpm_call, env=swiftpm_environment(toolchain), verbose=verbose)
 
 # -----------------------------------------------------------------------------
 # Arugment Parsing functions
@@ -709,6 +1122,8 @@ def generate_source_code_command(args: argparse.Namespace) -> None:
         )
     except subprocess.CalledProcessError as e:
         fail_for_called_process_error("Generating .gyb files failed", e)
+    except GybTemplateError as e:
+        fail_for_gyb_template_error("Generating .gyb files failed", e)
 
     try:
         if not args.gyb_only:
@@ -740,15 +1155,9 @@ def verify_source_code_command(args: argparse.Namespace) -> None:
 
         verify_c_syntax_nodes_match()
     except subprocess.CalledProcessError:
-        printerr(
-            "FAIL: Gyb-generated files committed to repository do " +
-            "not match generated ones. Please re-generate the " +
-            "gyb-files using the following command, open a PR to the " +
-            "SwiftSyntax project and merge it alongside the main PR." +
-            "$ swift-syntax/build-script.py generate-source-code " +
-            "--toolchain /path/to/toolchain.xctoolchain/usr"
-        )
-        raise SystemExit(1)
+        fail_for_mismatching_generated_files()
+    except GybTemplateError as e:
+        fail_for_gyb_template_error("Verifying gyb-generated files failed", e)
 
 
 def build_command(args: argparse.Namespace) -> None:
@@ -761,21 +1170,28 @@ def build_command(args: argparse.Namespace) -> None:
             verbose=args.verbose,
             disable_sandbox=args.disable_sandbox,
         )
-        # Until rdar://53881101 is implemented, we cannot request a build of multiple
-        # targets simultaneously. For now, just build one product after the other.
-        builder.build("SwiftSyntax")
-        builder.build("SwiftSyntaxParser")
-        builder.build("SwiftSyntaxBuilder")
-        builder.build("SwiftSyntaxBuilderGeneration")
+        # In a unified build, the package graph contains the other projects as
+        # well, so only build SwiftSyntax's products one after the other.
+        if builder.is_unified_build:
+            for product_name in [
+                "SwiftSyntax",
+                "SwiftSyntaxParser",
+                "SwiftSyntaxBuilder",
+                "SwiftSyntaxBuilderGeneration",
+            ]:
+                builder.build(product_name)
+        else:
+            builder.build_package()
     except subprocess.CalledProcessError as e:
         fail_for_called_process_error("Building SwiftSyntax failed", e)
 
 
 def test_command(args: argparse.Namespace) -> None:
+    build_dir = realpath(args.build_dir)
     try:
         builder = Builder(
             toolchain=args.toolchain,
-            build_dir=realpath(args.build_dir),
+            build_dir=build_dir,
             multiroot_data_file=args.multiroot_data_file,
             release=args.release,
             verbose=args.verbose,
@@ -786,7 +1202,7 @@ def test_command(args: argparse.Namespace) -> None:
 
         run_tests(
             toolchain=args.toolchain,
-            build_dir=realpath(args.build_dir),
+            build_dir=build_dir,
             multiroot_data_file=args.multiroot_data_file,
             release=args.release,
             filecheck_exec=realpath(args.filecheck_exec),